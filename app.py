@@ -1,9 +1,18 @@
 import streamlit as st
 import os
-import glob
 from PIL import Image
-from collections import Counter
+import numpy as np
+import pandas as pd
 import json
+import io
+import math
+import functools
+import struct
+import hashlib
+from base64 import b64encode
+from html import escape
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -13,15 +22,33 @@ st.set_page_config(
 
 # --- Constants ---
 SAVED_PATHS_FILE = "saved_paths.json"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+THUMBNAIL_WIDTH = 256
+ROWS_PER_PAGE = 6
+COLS_PER_ROW_OPTIONS = [1, 2, 3, 4, 5, 6, 8, 10]
+POWER_LABELS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 # --- Session State Initialization ---
+# Gallery tiles link to `?img=<path>` plus the current view params, which
+# reloads the app in a fresh session, so seed the view state from the URL.
 if 'selected_image' not in st.session_state:
-    st.session_state.selected_image = None
+    st.session_state.selected_image = st.query_params.get("img")
+if 'page' not in st.session_state:
+    try:
+        st.session_state.page = max(0, int(st.query_params.get("page", 0)))
+    except ValueError:
+        st.session_state.page = 0
+if 'cols_per_row' not in st.session_state:
+    cols = st.query_params.get("cols", "4")
+    st.session_state.cols_per_row = int(cols) if cols.isdigit() and int(cols) in COLS_PER_ROW_OPTIONS else 4
+if 'show_dims' not in st.session_state:
+    st.session_state.show_dims = st.query_params.get("dims") == "1"
 
 # --- Helper Functions ---
-def load_paths():
-    if not os.path.exists(SAVED_PATHS_FILE):
-        return ["."]
+@st.cache_data(show_spinner=False)
+def _load_paths(mtime):
+    # `mtime` is only part of the cache key, so edits to the file invalidate it.
     try:
         with open(SAVED_PATHS_FILE, "r") as f:
             paths = json.load(f)
@@ -29,43 +56,191 @@ def load_paths():
     except (json.JSONDecodeError, FileNotFoundError):
         return ["."]
 
-def save_paths(paths):
-    unique_paths = sorted(list(set(paths)))
+def load_paths():
+    try:
+        return _load_paths(os.path.getmtime(SAVED_PATHS_FILE))
+    except FileNotFoundError:
+        return ["."]
+
+def save_paths():
+    # st.session_state.saved_paths is an insertion-ordered dict used as a set.
+    # Merge in the file first so paths saved by other sessions aren't dropped.
+    st.session_state.saved_paths = {**dict.fromkeys(load_paths()), **st.session_state.saved_paths}
     with open(SAVED_PATHS_FILE, "w") as f:
-        json.dump(unique_paths, f, indent=4)
+        json.dump(list(st.session_state.saved_paths), f, indent=4)
+    _load_paths.clear()
 
-def get_image_files(path):
+def is_image_name(name):
+    # Name check first so non-images never cost an is_file() lookup.
+    return not name.startswith(".") and name.lower().endswith(IMAGE_EXTENSIONS)
+
+def scan_image_dir(path):
+    # One scandir pass per rerun returning (path, size, mtime_ns) tuples for
+    # every image plus a hash of them. Unlike the directory mtime, the hash
+    # also changes when a file is rewritten in place, so it keys the cached
+    # work downstream.
     if not path or not os.path.isdir(path):
-        return []
-    search_patterns = [os.path.join(path, f"*.{ext}") for ext in ["png", "jpg", "jpeg", "bmp", "gif"]]
+        return [], None
     image_files = []
-    for pattern in search_patterns:
-        image_files.extend(glob.glob(pattern))
-    return sorted(image_files)
+    try:
+        with os.scandir(path) as entries:
+            for e in entries:
+                if is_image_name(e.name) and e.is_file():
+                    stat = e.stat()
+                    image_files.append((e.path, stat.st_size, stat.st_mtime_ns))
+    except OSError:
+        # Unreadable directory, or a file vanished mid-scan: treat as empty.
+        return [], None
+    image_files.sort()
+    h = hashlib.blake2b(digest_size=8)
+    for file_path, size, mtime in image_files:
+        # fsencode round-trips undecodable (surrogate-escaped) file names.
+        h.update(os.fsencode(file_path) + f"\0{size}\0{mtime}\n".encode())
+    return image_files, int.from_bytes(h.digest(), "little")
+
+def display_name(path):
+    # Undecodable file names can't be sent to the browser as-is.
+    return os.path.basename(path).encode("utf-8", "replace").decode("utf-8")
+
+def read_dims(path):
+    # PNG stores width/height at a fixed offset in the IHDR chunk, so read them
+    # straight from the header; everything else goes through Pillow's lazy open,
+    # which parses the header without decoding pixel data.
+    with open(path, "rb") as f:
+        header = f.read(24)
+        if header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+            return struct.unpack(">II", header[16:24])
+        f.seek(0)
+        with Image.open(f) as img:
+            return img.size
+
+@functools.lru_cache(maxsize=65536)
+def _read_dims_or_error(path, size, mtime):
+    # Runs on worker threads: plain I/O only, no Streamlit calls. `size` and
+    # `mtime` only key the per-file cache, so when one file changes the batch
+    # below re-reads just that file's header.
+    try:
+        return read_dims(path), None
+    except Exception as e:
+        # Pillow's messages embed the file name, which may be undecodable.
+        return (-1, -1), str(e).encode("utf-8", "replace").decode("utf-8")
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def collect_dims(fingerprint, _image_entries):
+    # Keyed on the directory fingerprint only; the leading underscore keeps
+    # Streamlit from hashing the (path, size, mtime) entries on every call.
+    # Every change to a directory yields a new fingerprint, so keep only a few
+    # batches; the per-file cache above makes rebuilding one cheap.
+    # Returns an (N, 2) width/height array, with -1 rows for unreadable files,
+    # and a {path: error} dict for those files.
+    if not _image_entries:
+        return np.empty((0, 2), dtype=np.int64), {}
+    paths, sizes, mtimes = zip(*_image_entries)
+    # Header reads are I/O bound, so a thread pool overlaps the waits.
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as ex:
+        results = list(ex.map(_read_dims_or_error, paths, sizes, mtimes))
+    dims = np.array([d for d, _ in results], dtype=np.int64)
+    errors = {path: err for path, (_, err) in zip(paths, results) if err}
+    return dims, errors
+
+@st.cache_data(show_spinner=False, max_entries=1000)
+def thumb_bytes(fs_path, mtime, width=THUMBNAIL_WIDTH):
+    # `fs_path` is os.fsencode()d: Streamlit hashes str args as UTF-8, which
+    # fails on undecodable file names. `mtime` is only part of the cache key.
+    # Returns None for files Pillow cannot decode (corrupt, truncated, too
+    # large); the failure is cached too, and a file that finishes writing
+    # gets a new mtime anyway.
+    try:
+        with Image.open(fs_path) as img:
+            img.thumbnail((width, width * 4), Image.Resampling.BILINEAR)
+            if img.has_transparency_data:
+                # JPEG has no alpha; flatten onto white rather than black.
+                rgba = img.convert("RGBA")
+                img = Image.new("RGB", rgba.size, "white")
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=80)
+            return buf.getvalue()
+    except Exception:
+        return None
+
+def select_image(path):
+    st.session_state.selected_image = path
+    st.query_params["img"] = path
 
 def reset_gallery_view():
     st.session_state.selected_image = None
+    st.query_params.pop("img", None)
+
+def set_page(page):
+    st.session_state.page = page
+    st.query_params["page"] = str(page)
+
+def back_to_gallery(index):
+    # Land on the page holding the image last shown in the focused view.
+    set_page(index // (st.session_state.cols_per_row * ROWS_PER_PAGE))
+    reset_gallery_view()
+
+def image_tile(path, mtime):
+    # The page, column count and dims toggle are mirrored into st.query_params,
+    # so carrying them over keeps the view intact across the reload.
+    href = escape("?" + urlencode({**st.query_params.to_dict(), "img": path}, errors="surrogateescape"))
+    name = escape(display_name(path))
+    thumb = thumb_bytes(os.fsencode(path), mtime)
+    if thumb is None:
+        preview = (
+            '<div style="aspect-ratio:1;display:flex;align-items:center;justify-content:center;'
+            'border:1px dashed #999;border-radius:0.25rem;">⚠️ Cannot preview</div>'
+        )
+    else:
+        src = "data:image/jpeg;base64," + b64encode(thumb).decode()
+        preview = f'<img src="{src}" alt="{name}" style="width:100%;border-radius:0.25rem;">'
+    return (
+        f'<a href="{href}" target="_self" style="text-decoration:none;color:inherit;">'
+        f'{preview}'
+        f'<div style="text-align:center;font-size:0.875rem;overflow-wrap:anywhere;">{name}</div></a>'
+    )
 
+def gallery_html(page_entries, cols_per_row):
+    # The whole page goes out as one markdown element instead of a column and
+    # image element per tile.
+    tiles = "".join(image_tile(path, mtime) for path, _, mtime in page_entries)
+    return f'<div style="display:grid;grid-template-columns:repeat({cols_per_row},1fr);gap:1rem;">{tiles}</div>'
+
+def change_directory():
+    reset_gallery_view()
+    set_page(0)
+
+@functools.lru_cache(maxsize=4096)
 def format_bytes(size_bytes):
-    if size_bytes == 0:
+    if not size_bytes:
         return "0B"
-    power = 1024; n = 0
-    power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
-    while size_bytes >= power and n < len(power_labels) - 1:
-        size_bytes /= power; n += 1
-    return f"{size_bytes:.2f} {power_labels[n]}"
+    n = min(max(int(math.log(size_bytes, 1024)), 0), len(POWER_LABELS) - 1)
+    return f"{size_bytes / 1024 ** n:.2f} {POWER_LABELS[n]}"
 
 # --- Sidebar for Inputs ---
 with st.sidebar:
     st.header("📁 Directory Setup")
 
-    saved_paths = load_paths()
+    if 'saved_paths' not in st.session_state:
+        st.session_state.saved_paths = dict.fromkeys(load_paths())
+    saved_paths = list(st.session_state.saved_paths)
+
+    # Reopen the directory of an image selected through the URL.
+    selected_dir = os.path.dirname(st.session_state.selected_image or "")
+    if selected_dir and selected_dir not in saved_paths and "test_image_dir" not in st.session_state \
+            and os.path.isdir(selected_dir):
+        st.session_state.test_image_dir = selected_dir
+        st.session_state.test_image_files, _ = scan_image_dir(selected_dir)
+    if "image_dir" not in st.session_state and selected_dir in saved_paths:
+        st.session_state.image_dir = selected_dir
 
     image_dir = st.selectbox(
         "Select a saved directory:",
         options=saved_paths,
         format_func=lambda x: os.path.basename(x) if x != "." else "Current Directory",
-        on_change=reset_gallery_view
+        on_change=change_directory,
+        key="image_dir"
     )
 
     st.divider()
@@ -77,9 +252,9 @@ with st.sidebar:
     if st.button("Save Path"):
         if new_path and os.path.isdir(expanded_path):
             abs_path = os.path.abspath(expanded_path)
-            if abs_path not in saved_paths:
-                saved_paths.append(abs_path)
-                save_paths(saved_paths)
+            if abs_path not in st.session_state.saved_paths:
+                st.session_state.saved_paths[abs_path] = None
+                save_paths()
                 st.success(f"Saved: {abs_path}")
                 st.rerun()
             else:
@@ -89,7 +264,8 @@ with st.sidebar:
 
     if st.button("Test Path"):
         if new_path and os.path.isdir(expanded_path):
-            st.session_state.test_image_files = get_image_files(expanded_path)
+            st.session_state.test_image_dir = expanded_path
+            st.session_state.test_image_files, _ = scan_image_dir(expanded_path)
             if st.session_state.test_image_files:
                 st.success(f"Found {len(st.session_state.test_image_files)} images in {expanded_path}")
             else:
@@ -97,15 +273,23 @@ with st.sidebar:
         else:
             st.error("The specified path is not a valid directory.")
 
+    st.divider()
+
+    # Dimension stats open every image header, so only read them on request.
+    show_dims = st.toggle("Read image dimensions", key="show_dims")
+    st.query_params["dims"] = "1" if show_dims else "0"
+
 # --- Main App ---
 st.header("🖼️ Model Visualization Tool")
 
 # Decide whether to show test images or saved path images
 if "test_image_files" in st.session_state and st.session_state.test_image_files:
     st.info("Previewing images from the test path (not saved). Clear sidebar or rerun to return to saved paths.")
-    image_files = st.session_state.test_image_files
+    gallery_dir = st.session_state.test_image_dir
 else:
-    image_files = get_image_files(image_dir)
+    gallery_dir = image_dir
+image_entries, fingerprint = scan_image_dir(gallery_dir)
+image_files = [path for path, _, _ in image_entries]
 
 if st.session_state.selected_image and st.session_state.selected_image not in image_files:
     reset_gallery_view()
@@ -124,10 +308,10 @@ with tab1:
             st.image(st.session_state.selected_image, use_container_width=True)
             col1, col2, col3, col4 = st.columns([1, 1, 5, 1])
             if col1.button("⬅️ Previous", use_container_width=True, disabled=(current_index == 0)):
-                st.session_state.selected_image = image_files[current_index - 1]; st.rerun()
+                select_image(image_files[current_index - 1]); st.rerun()
             if col2.button("Next ➡️", use_container_width=True, disabled=(current_index == len(image_files) - 1)):
-                st.session_state.selected_image = image_files[current_index + 1]; st.rerun()
-            if col4.button("Back to Gallery 🖼️", use_container_width=True, on_click=reset_gallery_view):
+                select_image(image_files[current_index + 1]); st.rerun()
+            if col4.button("Back to Gallery 🖼️", use_container_width=True, on_click=back_to_gallery, args=(current_index,)):
                 st.rerun()
         except ValueError:
             st.error("The selected image could not be found."); reset_gallery_view(); st.rerun()
@@ -135,53 +319,70 @@ with tab1:
     else:
         meta_cols = st.columns(4)
         with meta_cols[0]:
-            st.metric("Total Images", value=len(image_files) if image_files else 0)
+            st.metric("Total Images", value=len(image_entries))
         with meta_cols[1]:
-            total_size_bytes = sum(os.path.getsize(f) for f in image_files) if image_files else 0
-            if image_files:
-                avg_size = total_size_bytes / len(image_files)
+            total_size_bytes = sum(size for _, size, _ in image_entries)
+            if image_entries:
+                avg_size = total_size_bytes / len(image_entries)
                 st.markdown(f"**Average Size:** {format_bytes(avg_size)}")
             st.metric("Total Size", value=format_bytes(total_size_bytes))
         with meta_cols[2]:
             st.markdown("**Image Dimensions**")
-            if image_files:
-                all_dims = [img.size for f in image_files if (img := Image.open(f)) is not None]
-                if not all_dims:
+            if not show_dims:
+                st.caption("Turn on *Read image dimensions* in the sidebar.")
+            elif image_entries:
+                dims, _ = collect_dims(fingerprint, image_entries)
+                dims_arr = dims[dims[:, 0] >= 0]
+                if not len(dims_arr):
                     st.markdown("N/A")
                 else:
-                    avg_w = sum(w for w, _ in all_dims) / len(all_dims)
-                    avg_h = sum(h for _, h in all_dims) / len(all_dims)
-                    dim_counts = Counter(all_dims)
-                    prefix = "~" if len(dim_counts) > 1 else ""
+                    avg_w, avg_h = dims_arr.mean(axis=0)
+                    uniq, counts = np.unique(dims_arr, axis=0, return_counts=True)
+                    order = np.argsort(-counts, kind="stable")
+                    prefix = "~" if len(uniq) > 1 else ""
                     st.markdown(f"**Average Dimension:** {prefix}{int(avg_w)}x{int(avg_h)}")
-                    breakdown = [f"- `{w}x{h}`: **{c}** ({(c / len(all_dims)) * 100:.1f}%)" for (w, h), c in dim_counts.most_common()]
-                    with st.expander(f"{len(dim_counts)} unique sizes"):
+                    breakdown = [f"- `{w}x{h}`: **{c}** ({(c / len(dims_arr)) * 100:.1f}%)" for (w, h), c in zip(uniq[order].tolist(), counts[order].tolist())]
+                    with st.expander(f"{len(uniq)} unique sizes"):
                         st.markdown("\n".join(breakdown))
             else:
                 st.markdown("N/A")
         with meta_cols[3]:
-            cols_per_row = st.selectbox("Images per row:", options=[1, 2, 3, 4, 5, 6, 8, 10], index=3)
+            # Not keyed: the focused view doesn't render this widget, and
+            # Streamlit would drop a keyed widget's state while it is hidden.
+            cols_per_row = st.selectbox(
+                "Images per row:",
+                options=COLS_PER_ROW_OPTIONS,
+                index=COLS_PER_ROW_OPTIONS.index(st.session_state.cols_per_row)
+            )
+            st.session_state.cols_per_row = cols_per_row
+            st.query_params["cols"] = str(cols_per_row)
         st.divider()
-        cols = st.columns(cols_per_row)
-        for i, image_file in enumerate(image_files):
-            with cols[i % cols_per_row]:
-                st.image(image_file, use_container_width=True, caption=os.path.basename(image_file))
-                if st.button("View", key=f"view_{image_file}"):
-                    st.session_state.selected_image = image_file; st.rerun()
+        page_size = cols_per_row * ROWS_PER_PAGE
+        num_pages = max(1, -(-len(image_files) // page_size))
+        page = min(st.session_state.page, num_pages - 1)
+        set_page(page)
+        if num_pages > 1:
+            nav_cols = st.columns([1, 1, 5])
+            if nav_cols[0].button("⬅️ Prev Page", use_container_width=True, disabled=(page == 0)):
+                set_page(page - 1); st.rerun()
+            if nav_cols[1].button("Next Page ➡️", use_container_width=True, disabled=(page == num_pages - 1)):
+                set_page(page + 1); st.rerun()
+            nav_cols[2].markdown(f"Page **{page + 1}** of **{num_pages}**")
+        page_entries = image_entries[page * page_size:(page + 1) * page_size]
+        st.markdown(gallery_html(page_entries, cols_per_row), unsafe_allow_html=True)
 
 with tab2:
     st.header("Analysis")
-    if image_files:
+    if not show_dims:
+        st.info("Turn on *Read image dimensions* in the sidebar to analyze this directory.")
+    elif image_files:
         st.subheader("Image Dimensions Analysis")
-        image_dims = []
-        for img_path in image_files:
-            try:
-                with Image.open(img_path) as img: image_dims.append(img.size)
-            except Exception as e:
-                st.warning(f"Could not read {os.path.basename(img_path)}: {e}")
-        if image_dims:
-            import pandas as pd
-            df = pd.DataFrame(image_dims, columns=['Width', 'Height'], index=[os.path.basename(p) for p in image_files])
+        dims, errors = collect_dims(fingerprint, image_entries)
+        for img_path, err in errors.items():
+            st.warning(f"Could not read {display_name(img_path)}: {err}")
+        readable = dims[:, 0] >= 0
+        if readable.any():
+            df = pd.DataFrame(dims[readable], columns=['Width', 'Height'], index=[display_name(p) for p, ok in zip(image_files, readable) if ok])
             st.dataframe(df)
             st.subheader("Distribution of Image Widths")
             st.bar_chart(df['Width'])